@@ -2,25 +2,39 @@
 
 from __future__ import print_function
 
+from concurrent.futures import ThreadPoolExecutor
 from datetime import datetime
-from io import BytesIO
+import codecs
+import errno
 import hashlib
+import hmac
 import json
 import math
+import mmap
 import os
+import random
 import shutil
+import ssl
 import subprocess
 import sys
+import tempfile
 import time
 import zipfile
-import urllib.request
 
 from appdirs import *
-from strictyaml import load, Map, Str, Int, Seq, YAMLError
+from strictyaml import load, Map, Str, Int, Optional, Seq, YAMLError
 
 import requests
+from requests.adapters import HTTPAdapter
 import semver
 
+# Optional dependency: if available, use the faster orjson parser for the
+# recipes. Both accept the raw UTF-8 bytes as well as a str.
+try:
+    from orjson import loads as json_loads
+except ImportError:
+    from json import loads as json_loads
+
 # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # # #
 #                                                                             #
 # soup                                                                        #
@@ -54,38 +68,49 @@ SCRIPT_NAME = "Creamy SourceMod Updater"
 # that's what you want.
 SCRIPT_VERSION = semver.VersionInfo.parse("1.6.2")
 
-CFG_DIR = os.environ.get("SOUP_CFG_DIR") or user_config_dir("soup")
-with open(os.path.join(CFG_DIR, "config.yml"), "r") as f:
-    YAML_CFG_SCHEMA = Map({
-        "game_dir": Str(),
-        "encoding": Str(),
-        "verbosity": Int(),
-        "recipes": Seq(Str()),
-        "gh_username": Str(),
-        "gh_personal_access_token": Str(),
-    })
-    CFG = load(f.read(), YAML_CFG_SCHEMA)
-assert CFG is not None
+YAML_CFG_SCHEMA = Map({
+    "game_dir": Str(),
+    "encoding": Str(),
+    "verbosity": Int(),
+    "recipes": Seq(Str()),
+    "gh_username": Str(),
+    "gh_personal_access_token": Str(),
+    Optional("max_concurrency", default=5): Int(),
+})
+
+# The config, and the values below derived from it, are only loaded by
+# init_config() when the script runs, so that importing this module has no
+# side effects.
+
+# Directory of the config file. Any caches get stored there as well.
+CFG_DIR = None
+CFG = None
+
+# Output verbosity level, see config.yml for the meaning of the values.
+VERBOSITY = 0
+# Canonical name of the configured text encoding, as known to codecs.
+ENCODING = None
 
 # Relative path to the server's "addons/sourcemod/plugins" directory.
-PLUGINS_LOCAL_PATH = os.path.join(".", CFG["game_dir"].value, "addons",
-                                  "sourcemod", "plugins")
+PLUGINS_LOCAL_PATH = None
 # Relative path to the server's "addons/sourcemod/scripting" directory.
-SCRIPTING_LOCAL_PATH = os.path.join(".", CFG["game_dir"].value, "addons",
-                                    "sourcemod", "scripting")
+SCRIPTING_LOCAL_PATH = None
 # Relative path to the server's code includes directory.
-INCLUDES_LOCAL_PATH = os.path.join(SCRIPTING_LOCAL_PATH, "include")
+INCLUDES_LOCAL_PATH = None
+# Prefixes for building the paths of files within the above directories.
+SCRIPTING_PATH_PREFIX = None
+INCLUDES_PATH_PREFIX = None
 
 # Path where to find SourceMod's "spcomp" compiler binary. Should be the
 # "scripting" folder by default. Note: If you're running a Windows SRCDS
 # binary through Wine, you'll need to point this to the spcomp Linux binary
 # of the same SM Windows version that you're running on that Wine server.
-PLUGINS_COMPILER_PATH = SCRIPTING_LOCAL_PATH
+PLUGINS_COMPILER_PATH = None
+# Absolute path to the "spcomp" compiler binary within the above directory.
+PLUGINS_COMPILER_BIN = None
 
-assert os.path.isdir(PLUGINS_LOCAL_PATH)
-assert os.path.isdir(SCRIPTING_LOCAL_PATH)
-assert os.path.isdir(INCLUDES_LOCAL_PATH)
-assert os.path.isdir(PLUGINS_COMPILER_PATH)
+# Resolved path to this script, which gets replaced on self-update.
+SCRIPT_REAL_PATH = os.path.realpath(__file__)
 
 GH_API_URL = "https://api.github.com"
 GH_REPO_OWNER = "CreamySoup"
@@ -94,44 +119,353 @@ GH_REPO_BASE = f"{GH_API_URL}/repos/{GH_REPO_OWNER}/{GH_REPO_NAME}"
 GH_RELEASES = f"{GH_REPO_BASE}/releases/latest"
 assert GH_API_URL.startswith("https://")  # require TLS
 
-
-def get_url_contents(url):
+# Name of the file in CFG_DIR where to persist the HTTP ETags of previous
+# GitHub API responses, for making conditional requests.
+ETAG_CACHE_FILE = "etag_cache.json"
+
+# Minimum number of seconds between checks for a new release of the script.
+SELF_UPDATE_CHECK_INTERVAL = 60 * 60
+
+# Name of the file in CFG_DIR where to persist the HTTP validators of
+# previously fetched recipes along with their entries, and of previously
+# fetched remote source files along with their hashes, for making
+# conditional requests. Also holds the hashes of local source files along
+# with their size and mtime.
+HASH_CACHE_FILE = "hash_cache.json"
+
+# Every this many runs, re-hash all local source files instead of trusting
+# their cached hashes, in case a file was changed without its size or mtime
+# changing along with it.
+DEEP_VERIFY_INTERVAL = 10
+
+# Block size in bytes to use when hashing files.
+HASH_BLOCK_SIZE = 64 * 1024
+# Files of at least this size in bytes get hashed straight from a memory
+# map of them, instead of being copied through a buffer block by block.
+HASH_MMAP_MIN_SIZE = 256 * 1024
+
+# Maximum number of bytes of the self-update release archive to buffer in
+# memory; anything beyond that is buffered in a temporary file instead.
+ZIPBALL_MAX_MEMORY = 16 * 1024 * 1024
+# Chunk size in bytes to use when streaming downloads.
+DOWNLOAD_CHUNK_SIZE = 64 * 1024
+
+# Timeout in seconds for any single HTTP request.
+HTTP_TIMEOUT = 30
+# How many times to retry a failed HTTP request, and the maximum delay in
+# seconds to wait before a retry. If the server asks us to wait for longer
+# than that (e.g. until the rate limit resets), we give up instead.
+HTTP_MAX_RETRIES = 5
+HTTP_MAX_RETRY_DELAY = 60
+
+# All HTTP traffic goes through this one session, so that connections to the
+# same hosts are kept alive and reused instead of paying for a new TCP+TLS
+# handshake on each request.
+SESSION = requests.Session()
+SESSION.mount("https://", HTTPAdapter(pool_connections=10, pool_maxsize=20))
+
+
+def init_config():
+    global CFG_DIR, CFG, VERBOSITY, ENCODING, PLUGINS_LOCAL_PATH, \
+        SCRIPTING_LOCAL_PATH, INCLUDES_LOCAL_PATH, SCRIPTING_PATH_PREFIX, \
+        INCLUDES_PATH_PREFIX, PLUGINS_COMPILER_PATH, PLUGINS_COMPILER_BIN, \
+        print_info, print_debug
+
+    # Only load the config once, however many callers ask for it.
+    if CFG is not None:
+        return CFG
+
+    CFG_DIR = os.environ.get("SOUP_CFG_DIR") or user_config_dir("soup")
+    with open(os.path.join(CFG_DIR, "config.yml"), "r") as f:
+        cfg = load(f.read(), YAML_CFG_SCHEMA)
+    if cfg is None:
+        raise RuntimeError("Failed to load the config file")
+    # The schema has done its job by now; keep the plain values around, so
+    # that reading them doesn't go through strictyaml's wrappers each time.
+    cfg = cfg.data
+
+    VERBOSITY = cfg["verbosity"]
+    # Resolving the name here also catches an unknown encoding on startup.
+    ENCODING = codecs.lookup(cfg["encoding"]).name
+
+    # Bind the output helpers once for the configured verbosity, so that
+    # the silenced ones don't even check it on each call.
+    print_info = print_formatted if VERBOSITY > 0 else print_nothing
+    print_debug = print_formatted if VERBOSITY > 1 else print_nothing
+
+    PLUGINS_LOCAL_PATH = os.path.join(".", cfg["game_dir"], "addons",
+                                      "sourcemod", "plugins")
+    SCRIPTING_LOCAL_PATH = os.path.join(".", cfg["game_dir"],
+                                        "addons", "sourcemod", "scripting")
+    INCLUDES_LOCAL_PATH = os.path.join(SCRIPTING_LOCAL_PATH, "include")
+    SCRIPTING_PATH_PREFIX = SCRIPTING_LOCAL_PATH + os.sep
+    INCLUDES_PATH_PREFIX = INCLUDES_LOCAL_PATH + os.sep
+    PLUGINS_COMPILER_PATH = SCRIPTING_LOCAL_PATH
+    # Assuming here that any non-Windows platform is Linux,
+    # or uses a Linux style spcomp binary.
+    PLUGINS_COMPILER_BIN = os.path.abspath(os.path.join(
+        PLUGINS_COMPILER_PATH, "spcomp.exe" if os.name == "nt" else "spcomp"))
+
+    for path in (PLUGINS_LOCAL_PATH, SCRIPTING_LOCAL_PATH,
+                 INCLUDES_LOCAL_PATH, PLUGINS_COMPILER_PATH):
+        if not os.path.isdir(path):
+            raise RuntimeError(f"Directory doesn't exist: \"{path}\"")
+
+    if cfg["max_concurrency"] < 1:
+        raise RuntimeError("Config value max_concurrency must be at least 1, "
+                           f"got {cfg['max_concurrency']}")
+
+    # Keep at least one pooled connection per fetch worker, so that none of
+    # them has to open a connection of its own that is then thrown away.
+    SESSION.mount("https://", HTTPAdapter(
+        pool_connections=10,
+        pool_maxsize=max(20, cfg["max_concurrency"])))
+
+    # Only publish the config once all of the above succeeded, so that a
+    # failed load doesn't count as a loaded one.
+    CFG = cfg
+    return CFG
+
+
+# Returns the number of seconds to wait before retrying the request that got
+# the response r, or None if it shouldn't be retried.
+def get_retry_delay(r, attempt):
+    backoff = min(HTTP_MAX_RETRY_DELAY, 2 ** attempt) + random.random()
+    if r.status_code >= 500:
+        return backoff
+    if r.status_code not in (403, 429):
+        return None
+    # Primary and secondary rate limits, see:
+    # https://docs.github.com/en/rest/overview/resources-in-the-rest-api#rate-limiting
+    retry_after = r.headers.get("Retry-After")
+    if retry_after is not None:
+        delay = int(retry_after) if retry_after.isdigit() else backoff
+    elif r.headers.get("X-RateLimit-Remaining") == "0":
+        reset = r.headers.get("X-RateLimit-Reset", "")
+        if not reset.isdigit():
+            return None
+        delay = max(0, int(reset) - time.time()) + random.random()
+    elif r.status_code == 429:
+        delay = backoff
+    else:
+        return None
+    return delay if delay <= HTTP_MAX_RETRY_DELAY else None
+
+
+# Make a HTTP request, retrying with exponential backoff on connection
+# errors, server side errors, and rate limiting.
+def request_with_backoff(method, url, **kwargs):
+    for attempt in range(HTTP_MAX_RETRIES + 1):
+        try:
+            r = SESSION.request(method, url, timeout=HTTP_TIMEOUT, **kwargs)
+        except (requests.ConnectionError, requests.Timeout) as e:
+            if attempt == HTTP_MAX_RETRIES:
+                raise
+            delay = min(HTTP_MAX_RETRY_DELAY, 2 ** attempt) + random.random()
+            reason = e
+        else:
+            delay = get_retry_delay(r, attempt)
+            if delay is None or attempt == HTTP_MAX_RETRIES:
+                return r
+            reason = f"{r.status_code} {r.reason}"
+            # Hand the connection back to the pool, in case this was a
+            # streamed response whose body was never read.
+            r.close()
+        print_debug("==> Request to %s failed (%s); retrying in %.1f "
+                    "seconds...", url, reason, delay)
+        time.sleep(delay)
+
+
+def get_url_response(url, headers=None, stream=False):
     # Require TLS for anti-tamper.
     # Only checking URI scheme and trusting the request lib to handle the rest.
     assert url.startswith("https://")
+    r = request_with_backoff("GET", url, headers=headers, stream=stream)
     try:
-        return urllib.request.urlopen(url).read()
-    except urllib.error.HTTPError as e:
-        http_code_first_digit = int(str(e.code)[:1])
+        r.raise_for_status()
+    except requests.HTTPError:
+        r.close()
+        http_code_first_digit = int(str(r.status_code)[:1])
         # If it's a HTTP 5XX (server side error), don't error on our side.
         if http_code_first_digit == 5:
-            print(f"Got HTTP response from remote: {e.code} {e.reason}")
-        else:
-            raise
-    return None
+            print(f"Got HTTP response from remote: {r.status_code} {r.reason}")
+            return None
+        raise
+    return r
+
+
+# Read the body of the streamed response r, hashing it as it arrives instead
+# of going over all of it again afterwards. Returns a (contents, hash) tuple.
+def read_and_hash(r):
+    h = hashlib.sha256()
+    chunks = []
+    with r:
+        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            h.update(chunk)
+            chunks.append(chunk)
+    return b"".join(chunks), h.hexdigest()
+
+
+# Returns the headers for revalidating a response, given the validators
+# cached from it by get_validators.
+def get_conditional_headers(cached):
+    headers = {}
+    if cached is None:
+        return headers
+    if cached.get("etag") is not None:
+        headers["If-None-Match"] = cached["etag"]
+    if cached.get("last_modified") is not None:
+        headers["If-Modified-Since"] = cached["last_modified"]
+    return headers
+
+
+# Returns the validators of the response r to cache for later conditional
+# requests, or None if the response has none.
+def get_validators(r):
+    etag = r.headers.get("ETag")
+    last_modified = r.headers.get("Last-Modified")
+    if etag is None and last_modified is None:
+        return None
+    return {"etag": etag, "last_modified": last_modified}
+
+
+# Fetch a remote source file, skipping the download if it hasn't changed
+# since the previous fetch. Returns a (contents, hash) tuple, where contents
+# is None if the remote file is unchanged since then, or None if the file
+# couldn't be fetched at all.
+def fetch_source(url, url_hashes):
+    cached = url_hashes.get(url)
+    try:
+        r = get_url_response(url, get_conditional_headers(cached),
+                             stream=True)
+        if r is None:
+            return None
+        if r.status_code == 304:
+            r.close()
+            return None, cached["sha256"]
+        remote_data, remote_hash = read_and_hash(r)
+    except requests.RequestException as e:
+        print_request_error(url, e)
+        return None
+    validators = get_validators(r)
+    if validators is not None:
+        url_hashes[url] = {**validators, "sha256": remote_hash}
+    return remote_data, remote_hash
+
+
+# Fetch a recipe, revalidating it against the validators cached from its
+# previous fetch. Returns the response, or None if it couldn't be fetched.
+def fetch_recipe(url, recipe_cache):
+    try:
+        return get_url_response(url,
+                                get_conditional_headers(recipe_cache.get(url)))
+    except requests.RequestException as e:
+        print_request_error(url, e)
+        return None
 
 
-def print_info(msg):
-    if CFG["verbosity"].value > 0:
-        print(msg)
+# A single unreachable or broken URL shouldn't stop the updates from all of
+# the others, so failed requests are reported and then skipped over.
+def print_request_error(url, e):
+    print(f"Request to {url} failed: {e}")
 
 
-def print_debug(msg):
-    if CFG["verbosity"].value > 1:
-        print(msg)
+def load_json_cache(name):
+    # A missing or unreadable cache is not an error; we'll just rebuild it.
+    try:
+        with open(os.path.join(CFG_DIR, name), "r") as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
 
 
-def get_file_hash(file):
-    try:
-        return get_data_hash(file.read().encode(CFG["encoding"].value))
-    except UnicodeDecodeError as e:
-        return ""
+def save_json_cache(name, data):
+    write_file_atomic(os.path.join(CFG_DIR, name), json.dumps(data).encode())
 
 
-def get_data_hash(data):
-    res = hashlib.sha256(data).hexdigest()
-    assert len(res) > 0
-    return res
+# Write data to a temporary file next to path, and then move it in place of
+# path in one atomic operation. Readers of path will see either the old or
+# the new contents, but never a partially written file.
+def write_file_atomic(path, data):
+    tmp_path = path + ".tmp"
+    try:
+        with open(tmp_path, "wb") as f:
+            f.write(data)
+            f.flush()
+            os.fsync(f)
+        os.replace(tmp_path, path)
+    except BaseException:
+        # Don't leave a partially written file behind.
+        try:
+            os.remove(tmp_path)
+        except OSError:
+            pass
+        raise
+
+
+# The print helpers take printf-style format arguments, so that no time is
+# spent formatting messages that won't get printed at this verbosity level.
+# The arguments only get formatted into fmt once we know the message will
+# be printed.
+def print_formatted(fmt, *args):
+    print(fmt % args if args else fmt)
+
+
+def print_nothing(fmt, *args):
+    pass
+
+
+# Output helpers for the info and debug verbosity levels, see init_config().
+print_info = print_nothing
+print_debug = print_nothing
+
+
+def get_file_hash(path):
+    with open(path, "rb") as f:
+        if os.fstat(f.fileno()).st_size >= HASH_MMAP_MIN_SIZE:
+            with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as m:
+                return hashlib.sha256(m).hexdigest()
+        # Python 3.11+ can do the whole read & hash loop in C.
+        if hasattr(hashlib, "file_digest"):
+            return hashlib.file_digest(f, "sha256").hexdigest()
+        # Otherwise, hash in fixed-size blocks read into one reused buffer,
+        # so that memory use doesn't grow with the file size.
+        h = hashlib.sha256()
+        buf = bytearray(HASH_BLOCK_SIZE)
+        view = memoryview(buf)
+        while True:
+            size = f.readinto(buf)
+            if not size:
+                break
+            h.update(view[:size])
+    return h.hexdigest()
+
+
+# Like get_file_hash, but skips re-hashing the file if its size and
+# modification time still match those cached from when it was last hashed.
+# The caller may pass in the stat result of the file if it already has one.
+def get_file_hash_cached(path, file_hashes, st=None):
+    if st is None:
+        st = os.stat(path)
+    cached = file_hashes.get(os.path.abspath(path))
+    if cached is not None and cached["size"] == st.st_size and \
+            cached["mtime_ns"] == st.st_mtime_ns:
+        return cached["sha256"]
+    file_hash = get_file_hash(path)
+    # Cache the hash along with the stat taken before reading the file, so
+    # that a change made while we were hashing it gets noticed on next run.
+    cache_file_hash(path, file_hash, file_hashes, st)
+    return file_hash
+
+
+def cache_file_hash(path, file_hash, file_hashes, st=None):
+    if st is None:
+        st = os.stat(path)
+    file_hashes[os.path.abspath(path)] = {
+        "size": st.st_size,
+        "mtime_ns": st.st_mtime_ns,
+        "sha256": file_hash,
+    }
 
 
 def verify_gh_api_req(r):
@@ -153,20 +487,57 @@ def verify_gh_api_req(r):
             ratelimit_used is not None and ratelimit_reset is not None:
         reset_mins = int(math.ceil((int(ratelimit_reset) - time.time()) / 60))
         print_info("==> Using GitHub Releases API quota – "
-                   f"{ratelimit_remaining}/{ratelimit} requests remaining "
-                   f"(used {ratelimit_used} requests). This rate limit resets "
-                   f"in {reset_mins} minutes.")
+                   "%s/%s requests remaining (used %s requests). This rate "
+                   "limit resets in %d minutes.", ratelimit_remaining,
+                   ratelimit, ratelimit_used, reset_mins)
         if int(ratelimit_remaining) <= 0:
             return False
     return True
 
 
+# Compile a plugin with the compiler at the absolute compiler_path, and
+# return the compiler output. The compiled binary is written to output_dir;
+# compiles running in parallel should each have their own output_dir, so
+# that they won't collide.
+def compile_plugin(compiler_path, source_path, output_dir):
+    p = subprocess.run([compiler_path, os.path.abspath(source_path)],
+                       cwd=output_dir, stdout=subprocess.PIPE,
+                       stderr=subprocess.STDOUT)
+    output = p.stdout.decode(errors="replace")
+    if p.returncode != 0:
+        print(output)
+    p.check_returncode()
+    return output
+
+
 # Check for updates of this script itself
 def self_update():
-    print_info(f"=> Self-update check")
-
-    r = requests.get(GH_RELEASES, auth=(CFG["gh_username"].value,
-                                        CFG["gh_personal_access_token"].value))
+    print_info("=> Self-update check")
+
+    gh_auth = (CFG["gh_username"],
+               CFG["gh_personal_access_token"])
+
+    # If the latest release hasn't changed since we last found ourselves to
+    # be up to date with it, GitHub answers with a 304, which doesn't count
+    # against the API rate limit. If that was only a moment ago, don't even
+    # ask.
+    etag_cache = load_json_cache(ETAG_CACHE_FILE)
+    cached_etag = etag_cache.get(GH_RELEASES)
+    headers = {}
+    if cached_etag is not None and \
+            cached_etag.get("version") == str(SCRIPT_VERSION):
+        if 0 <= time.time() - cached_etag.get("checked_at", 0) < \
+                SELF_UPDATE_CHECK_INTERVAL:
+            print_debug("==> Checked for new releases recently; skipping.")
+            return
+        headers["If-None-Match"] = cached_etag["etag"]
+
+    r = request_with_backoff("GET", GH_RELEASES, headers=headers, auth=gh_auth)
+    if r.status_code == 304:
+        print_debug("==> No new releases since the last check.")
+        cached_etag["checked_at"] = time.time()
+        save_json_cache(ETAG_CACHE_FILE, etag_cache)
+        return
     if not verify_gh_api_req(r):
         return
     json_latest = r.json()
@@ -174,272 +545,419 @@ def self_update():
 
     if SCRIPT_VERSION >= latest_ver:
         if SCRIPT_VERSION > latest_ver:
-            print_debug(f"!! Running higher version ({SCRIPT_VERSION}) than "
-                        f"release version ({latest_ver})")
+            print_debug("!! Running higher version (%s) than release "
+                        "version (%s)", SCRIPT_VERSION, latest_ver)
+        etag = r.headers.get("ETag")
+        if etag is not None:
+            etag_cache[GH_RELEASES] = {"etag": etag,
+                                       "version": str(SCRIPT_VERSION),
+                                       "checked_at": time.time()}
+            save_json_cache(ETAG_CACHE_FILE, etag_cache)
         return
 
-    print_info(f"!! Script self-update: version \"{SCRIPT_VERSION}\" --> "
-               f"\"{latest_ver}\"...")
+    print_info("!! Script self-update: version \"%s\" --> \"%s\"...",
+               SCRIPT_VERSION, latest_ver)
 
     zip_url = json_latest.get("zipball_url")
 
-    release_commit_url = f"{GH_REPO_BASE}/git/ref/tags/{latest_ver}"
-
-    r = requests.get(release_commit_url,
-                     auth=(CFG["gh_username"].value,
-                           CFG["gh_personal_access_token"].value))
-    if not verify_gh_api_req(r):
-        return
-    release_commit_json = r.json()
-    hash_cutoff_point = 7
-    sha = release_commit_json["object"]["sha"][:hash_cutoff_point]
-
-    ballname_soup = f"{GH_REPO_OWNER}-{GH_REPO_NAME}-{sha}/soup.py"
-    ballname_reqs = f"{GH_REPO_OWNER}-{GH_REPO_NAME}-{sha}/requirements.txt"
-
-    with zipfile.ZipFile(BytesIO(urllib.request.urlopen(zip_url).read())) as z:
-        realpath = os.path.realpath(__file__)
-
-        with open(os.path.join(os.path.dirname(realpath), "requirements.txt"),
-                  "wb+") as f:
-            f.seek(0)
-            f.write(z.open(ballname_reqs).read())
-            f.truncate()
-            f.flush()
-            os.fsync(f.fileno())
-
-        subprocess.run(["pipenv", "install", "-r", "requirements.txt"]).check_returncode()
-
-        with open(realpath, "wb+") as f:
-            f.seek(0)
-            f.write(z.open(ballname_soup).read())
-            f.truncate()
-            f.flush()
-            os.fsync(f.fileno())
+    r = request_with_backoff("GET", zip_url, stream=True)
+    r.raise_for_status()
+    # Stream the release archive into a buffer that spills over to disk if
+    # it grows large, instead of holding all of it in memory. The files we
+    # need are then streamed out of it in the same way.
+    with tempfile.SpooledTemporaryFile(max_size=ZIPBALL_MAX_MEMORY) as buf:
+        for chunk in r.iter_content(chunk_size=DOWNLOAD_CHUNK_SIZE):
+            buf.write(chunk)
+        buf.seek(0)
+
+        with zipfile.ZipFile(buf) as z:
+            # Everything in the archive is under a single directory named
+            # "<owner>-<repo>-<short commit sha>", so take its name from the
+            # archive itself instead of asking the API for the tag's commit.
+            ballname_root = z.namelist()[0].split("/")[0]
+            ballname_soup = f"{ballname_root}/soup.py"
+            ballname_reqs = f"{ballname_root}/requirements.txt"
+
+            with open(os.path.join(os.path.dirname(SCRIPT_REAL_PATH),
+                                   "requirements.txt"), "wb") as f:
+                with z.open(ballname_reqs) as member:
+                    shutil.copyfileobj(member, f, DOWNLOAD_CHUNK_SIZE)
+                f.flush()
+                os.fsync(f.fileno())
+
+            subprocess.run(["pipenv", "install", "-r",
+                            "requirements.txt"]).check_returncode()
+
+            with open(SCRIPT_REAL_PATH, "wb") as f:
+                with z.open(ballname_soup) as member:
+                    shutil.copyfileobj(member, f, DOWNLOAD_CHUNK_SIZE)
+                f.flush()
+                os.fsync(f.fileno())
 
     print_info("!! Self-update successful.")
 
     # We have modified our own source code - restart the script
     print_info("!!! Restarting soup...")
+    # When not run from a terminal (e.g. from cron), stdout is block
+    # buffered; get our output out before the new process starts writing.
+    sys.stdout.flush()
     subprocess.check_call([sys.executable, ] + sys.argv)
     sys.exit(0)
 
 
-def check_for_updates(recipe):
-    print_info(f"=> Checking for recipe updates: {recipe}")
+# Bring a local source file up to date with its remote source, given the
+# results of fetch_source for this run keyed by source URL, and the
+# os.DirEntry of the local file (or None if it wasn't found in a directory
+# listing). The kind is only used for output, e.g. "include" or "plugin".
+# Returns whether the local file was updated.
+def sync_remote_file(kind, name, source_url, local_path, fetched_sources,
+                     file_hashes, local_file):
+    fetched = fetched_sources[source_url]
+    if fetched is None:
+        print(f"==> ! Failed to get remote {kind} for {name}, skipping its "
+              "update for now.")
+        return False
+    remote_data, remote_hash = fetched
+    if remote_data is None:
+        print_debug("==> %s code unchanged on remote since last fetch.",
+                    kind.capitalize())
+    print_debug("==> %s code remote hash: %s", kind.capitalize(),
+                remote_hash)
+
+    # A listing may be missing a file that exists after all, e.g. one that
+    # was created since; only a failed stat means that there's no such file.
+    if local_file is not None:
+        st = local_file.stat()
+    else:
+        try:
+            st = os.stat(local_path)
+        except FileNotFoundError:
+            st = None
+
+    if st is not None:
+        local_hash = get_file_hash_cached(local_path, file_hashes, st)
+        print_debug("==> %s code local hash: %s", kind.capitalize(),
+                    local_hash)
+        # Constant-time, since the remote side decides what we compare to.
+        if hmac.compare_digest(local_hash, remote_hash):
+            print_debug("===> Source code hashes are identical; no need to "
+                        "update %s \"%s\".", kind, name)
+            return False
 
-    update_file_contents = get_url_contents(recipe)
-    if update_file_contents is None:
-        return
-    update_file_contents = update_file_contents.decode(CFG["encoding"].value)
-    json_data = json.loads(update_file_contents)
+    print_debug("===> Source code hashes differ; updating %s \"%s\"!\n"
+                "====> Writing source code to disk...", kind, name)
+    if remote_data is None:
+        # The remote file hasn't changed since we last fetched it,
+        # but the local copy no longer matches it; fetch it again.
+        fetched = fetch_source(source_url, {})
+        if fetched is None:
+            print(f"==> ! Failed to get remote {kind} for {name}, skipping "
+                  "its update for now.")
+            return False
+        remote_data, remote_hash = fetched
+        # Any other file from the same source can reuse this download.
+        fetched_sources[source_url] = fetched
+    write_file_atomic(local_path, remote_data)
+
+    # The remote hash was computed on the exact bytes just written and
+    # fsynced, so there's no need to read them back and hash them again.
+    print_debug("====> Verifying %s code integrity...", kind)
+    st = os.stat(local_path)
+    assert st.st_size == len(remote_data), \
+        f"{st.st_size} should equal {len(remote_data)}"
+    cache_file_hash(local_path, remote_hash, file_hashes, st)
 
-    num_incs_processed = 0
-    num_incs_updated = 0
+    return True
 
-    num_plugins_processed = 0
-    num_plugins_updated = 0
-
-    root_sections = ["includes", "plugins", "updater"]
-    for root_section in root_sections:
-        kvs = json_data.get(root_section)
-        if kvs is None:
-            continue
-        if root_section == "updater":
-            print(f"==> ! Warning: config key '{root_section}' has been "
-                  "deprecated! Please update your config file.")
-            continue
-        for kv in kvs:
+
+# Parse the contents of a recipe. Returns its include and plugin entries as
+# two lists of (name, source_url) tuples, and whether it still has the
+# deprecated "updater" section.
+def parse_recipe(update_file_contents):
+    # JSON is UTF-8 by default, in which case the parser can take the bytes
+    # as they are.
+    if ENCODING != "utf-8":
+        update_file_contents = update_file_contents.decode(ENCODING)
+    json_data = json_loads(update_file_contents)
+
+    includes = []
+    plugins = []
+
+    # Output label and list of entries for each section of the recipe.
+    root_sections = {
+        "includes": ("Include", includes),
+        "plugins": ("Plugin", plugins),
+    }
+    for root_section, (label, entries) in root_sections.items():
+        for kv in json_data.get(root_section) or ():
             if kv is None:
                 continue
-            for index, (key, value) in enumerate(kv.items(), start=1):
-                if root_section == "includes":
-                    if key == "name":
-                        include_name = value
-                        local_inc_path = os.path.join(INCLUDES_LOCAL_PATH,
-                                                      (value + ".inc"))
-                        inc_exists_locally = os.path.isfile(local_inc_path)
-                        num_incs_processed += 1
-
-                    print_debug(f"=> Include {key}: \"{value}\"")
-
-                    if key == "source_url":
-                        remote_inc = get_url_contents(value)
-                        if remote_inc is None:
-                            print("==> ! Failed to get remote include for "
-                                  f"{include_name}, skipping its update for "
-                                  "now.")
-                            continue
-                        remote_inc_hash = get_data_hash(remote_inc)
-                        print_debug("==> Include code remote hash: "
-                                    f"{remote_inc_hash}")
-
-                        open_mode = "r+" if inc_exists_locally else "w"
-                        f = open(local_inc_path, open_mode, newline="\n")
-
-                        if inc_exists_locally:
-                            local_inc_hash = get_file_hash(f)
-                            print_debug("==> Include code local hash: "
-                                        f"{local_inc_hash}")
-
-                        hashes_match = (inc_exists_locally and
-                                        local_inc_hash == remote_inc_hash)
-
-                        if hashes_match:
-                            print_debug("===> Source code hashes are "
-                                        "identical; no need to update include "
-                                        f"\"{include_name}\".")
-                        else:
-                            print_debug("===> Source code hashes differ; "
-                                        f"updating include \"{include_name}"
-                                        "\"!\n"
-                                        "====> Writing source code to disk...")
-                            f.seek(0)
-                            f.write(remote_inc.decode(CFG["encoding"].value))
-                            f.truncate()
-                            f.flush()
-                            os.fsync(f)
-                        f.close()
-
-                        if not hashes_match:
-                            print_debug("====> Verifying include code "
-                                        "integrity...")
-                            assert os.path.isfile(local_inc_path)
-                            with open(local_inc_path, "r", newline="\n") as f:
-                                new_local_inc_hash = get_file_hash(f)
-
-                            hashes_match = \
-                                (new_local_inc_hash == remote_inc_hash)
-
-                            assert hashes_match, \
-                                (f"{new_local_inc_hash} should equal "
-                                 f"{remote_inc_hash}")
-
-                            print_debug("====> Finished updating include "
-                                        f"\"{include_name}\". This new "
-                                        "version will be used for any future "
-                                        "plugin compiles that require it.")
-
-                            num_incs_updated += 1
-
-                else:  # plugins
-                    if key == "name":
-                        plugin_name = value
-                        local_source_path = os.path.join(SCRIPTING_LOCAL_PATH,
-                                                         (value + ".sp"))
-                        code_exists_locally = os.path.isfile(local_source_path)
-                        num_plugins_processed += 1
-
-                    print_debug(f"=> Plugin {key}: \"{value}\"")
-
-                    if key == "source_url":
-                        remote_code = get_url_contents(value)
-                        if remote_code is None:
-                            print("==> ! Failed to get remote code for "
-                                  f"{plugin_name}, skipping its update for "
-                                  "now.")
-                            continue
-                        remote_code_hash = get_data_hash(remote_code)
-                        print_debug("==> Plugin code remote hash: "
-                                    f"{remote_code_hash}")
-
-                        open_mode = "r+" if code_exists_locally else "w"
-                        f = open(local_source_path, open_mode, newline="\n")
-
-                        if code_exists_locally:
-                            local_code_hash = get_file_hash(f)
-                            print_debug("==> Plugin code local hash: "
-                                        f"{local_code_hash}")
-
-                        hashes_match = (code_exists_locally and
-                                        local_code_hash == remote_code_hash)
-
-                        if hashes_match:
-                            print_debug("===> Source code hashes are "
-                                        "identical; no need to update plugin "
-                                        f"\"{plugin_name}\".")
-                        else:
-                            print_debug("===> Source code hashes differ; "
-                                        f"updating plugin \"{plugin_name}\"!\n"
-                                        "====> Writing source code to disk...")
-                            f.seek(0)
-                            f.write(remote_code.decode(CFG["encoding"].value))
-                            f.truncate()
-                            f.flush()
-                            os.fsync(f)
-                        f.close()
-
-                        if not hashes_match:
-                            print_debug("====> Verifying plugin code "
-                                        "integrity...")
-                            assert os.path.isfile(local_source_path)
-
-                            with open(local_source_path, "r",
-                                      newline="\n") as f:
-                                new_local_code_hash = get_file_hash(f)
-
-                            hashes_match = \
-                                (new_local_code_hash == remote_code_hash)
-
-                            assert hashes_match, \
-                                (f"{new_local_code_hash} "
-                                 f"should equal {remote_code_hash}")
-
-                            print_debug("====> Compiling plugin "
-                                        f"\"{plugin_name}\"...\n")
-
-                            platform_is_windows = (os.name == "nt")
-
-                            # Assuming here that any non-Windows platform is
-                            # Linux, or uses a Linux style spcomp binary.
-                            compiler_binary = "spcomp.exe" if \
-                                platform_is_windows else "spcomp"
-
-                            compiler_path = os.path.join(PLUGINS_COMPILER_PATH,
-                                                         compiler_binary)
-                            assert os.path.isfile(compiler_path)
-
-                            subprocess.run(
-                                [compiler_path,
-                                 local_source_path]).check_returncode()
-
-                            print_debug("\n====> Installing plugin "
-                                        f"\"{plugin_name}\"...")
-
-                            plugin_binary_path = os.path.join(".",
-                                                              f"{plugin_name}"
-                                                              ".smx")
-                            assert os.path.isfile(plugin_binary_path)
-
-                            '''
-                            print(f"""Current working directory is "
-\"{os.getcwd()}\" and trying to move the .smx from \"{plugin_binary_path}\"
-to {os.path.join(PLUGINS_LOCAL_PATH, (plugin_name + ".smx"))}""")
-                            '''
-
-                            shutil.move(plugin_binary_path,
-                                        os.path.join(PLUGINS_LOCAL_PATH,
-                                                     (plugin_name + ".smx")))
-
-                            print_debug("====> Finished updating plugin "
-                                        f"\"{plugin_name}\". It will be "
-                                        "reloaded by the server on the next "
-                                        "mapchange.")
-
-                            num_plugins_updated += 1
-
-    print_info(f"\n{num_incs_updated} of {num_incs_processed} "
-               "includes checked had received new updates.\n"
-               f"{num_plugins_updated} of {num_plugins_processed} "
-               "plugins checked had received new updates.")
+            for key, value in kv.items():
+                print_debug("=> %s %s: \"%s\"", label, key, value)
+            name = kv.get("name")
+            source_url = kv.get("source_url")
+            if name is None or source_url is None:
+                continue
+            entries.append((name, source_url))
+
+    return includes, plugins, json_data.get("updater") is not None
+
+
+# Returns the include and plugin entries of a recipe, given the response r
+# to fetching it. They're taken from recipe_cache if the recipe hasn't
+# changed since the last run, either because the server says so or because
+# it's the same as before, and parsed (and cached) otherwise. Either way,
+# warns about the recipe's use of deprecated sections.
+def get_recipe_entries(recipe, r, recipe_cache):
+    cached = recipe_cache.get(recipe)
+    if r.status_code == 304:
+        unchanged = True
+    else:
+        recipe_hash = hashlib.sha256(r.content).hexdigest()
+        unchanged = cached is not None and \
+            cached.get("sha256") == recipe_hash
+
+    if unchanged:
+        print_debug("=> Recipe unchanged since the last run.")
+        includes = [tuple(entry) for entry in cached["includes"]]
+        plugins = [tuple(entry) for entry in cached["plugins"]]
+        has_updater = cached.get("has_updater", False)
+    else:
+        includes, plugins, has_updater = parse_recipe(r.content)
+
+    if has_updater:
+        print("==> ! Warning: config key 'updater' has been deprecated! "
+              "Please update your config file.")
+
+    if r.status_code != 304:
+        recipe_cache[recipe] = {**(get_validators(r) or {}),
+                                "sha256": recipe_hash,
+                                "includes": includes,
+                                "plugins": plugins,
+                                "has_updater": has_updater}
+    return includes, plugins
+
+
+# Returns the os.DirEntry of the file at path, or None if there's no such
+# file. Each directory is only listed once, into listings, instead of
+# checking for each file in it separately; the DirEntry objects also cache
+# the files' stat results. Names may include subdirectories (e.g. an
+# include "smlib/arrays"), which get listed as they come up.
+def get_local_file(path, listings):
+    dir_path, file_name = os.path.split(path)
+    listing = listings.get(dir_path)
+    if listing is None:
+        try:
+            with os.scandir(dir_path) as it:
+                listing = {e.name: e for e in it if e.is_file()}
+        except FileNotFoundError:
+            listing = {}
+        listings[dir_path] = listing
+    return listing.get(file_name)
+
+
+# Bring the includes and plugins of a recipe up to date, given the results
+# of fetch_source for their source URLs. Returns the number of includes
+# updated, and a list of (name, source_path) tuples of the plugins updated,
+# which still need to be compiled.
+def update_from_recipe(recipe, includes, plugins, fetched_sources,
+                       file_hashes):
+    print_info("=> Updating from recipe: %s", recipe)
+
+    num_incs_updated = 0
+    plugins_to_compile = []
+
+    # Directory listings of the local files, see get_local_file().
+    listings = {}
+
+    for include_name, source_url in includes:
+        local_inc_path = INCLUDES_PATH_PREFIX + include_name + ".inc"
+        if sync_remote_file("include", include_name, source_url,
+                            local_inc_path, fetched_sources,
+                            file_hashes,
+                            get_local_file(local_inc_path, listings)):
+            print_debug("====> Finished updating include \"%s\". This new "
+                        "version will be used for any future plugin "
+                        "compiles that require it.", include_name)
+            num_incs_updated += 1
+
+    for plugin_name, source_url in plugins:
+        local_source_path = SCRIPTING_PATH_PREFIX + plugin_name + ".sp"
+        if sync_remote_file("plugin", plugin_name, source_url,
+                            local_source_path, fetched_sources,
+                            file_hashes,
+                            get_local_file(local_source_path, listings)):
+            plugins_to_compile.append((plugin_name, local_source_path))
+
+    return num_incs_updated, plugins_to_compile
+
+
+# Move a file in one atomic rename, unless it has to cross filesystems.
+def move_file(src_path, dst_path):
+    try:
+        os.replace(src_path, dst_path)
+    except OSError as e:
+        if e.errno != errno.EXDEV:
+            raise
+        shutil.move(src_path, dst_path)
+
+
+# Compile the given plugins, listed as (name, source_path) tuples, and move
+# the results into the plugins directory. A failed compile doesn't keep the
+# others from being installed. Returns the plugins that failed to compile.
+def compile_plugins(plugins_to_compile):
+    assert os.path.isfile(PLUGINS_COMPILER_BIN)
+
+    # The compiles run in their own processes, so threads are enough to
+    # have them run in parallel. Each plugin gets its own spcomp run, since
+    # spcomp treats all of the files given to it as one program. Building
+    # next to the plugins directory, rather than in the system's temporary
+    # directory, keeps the moves below on the same filesystem.
+    with tempfile.TemporaryDirectory(prefix="soup-build-",
+                                     dir=SCRIPTING_LOCAL_PATH) as build_dir, \
+            ThreadPoolExecutor(max_workers=os.cpu_count()) as executor:
+        compiles = []
+        for plugin_name, local_source_path in plugins_to_compile:
+            print_debug("====> Compiling plugin \"%s\"...", plugin_name)
+            output_dir = os.path.join(build_dir, plugin_name)
+            os.mkdir(output_dir)
+            compiles.append((plugin_name, local_source_path, output_dir,
+                             executor.submit(compile_plugin,
+                                             PLUGINS_COMPILER_BIN,
+                                             local_source_path, output_dir)))
+
+        failed_compiles = []
+        for plugin_name, local_source_path, output_dir, compile_job \
+                in compiles:
+            try:
+                print(compile_job.result())
+            except (subprocess.CalledProcessError, OSError) as e:
+                print(f"==> ! Failed to compile plugin \"{plugin_name}\": "
+                      f"{e}")
+                failed_compiles.append((plugin_name, local_source_path))
+                continue
+
+            print_debug("====> Installing plugin \"%s\"...", plugin_name)
+
+            plugin_binary_path = os.path.join(output_dir,
+                                              f"{plugin_name}.smx")
+            assert os.path.isfile(plugin_binary_path)
+
+            move_file(plugin_binary_path,
+                      os.path.join(PLUGINS_LOCAL_PATH,
+                                   (plugin_name + ".smx")))
+
+            print_debug("====> Finished updating plugin \"%s\". It will "
+                        "be reloaded by the server on the next mapchange.",
+                        plugin_name)
+
+    return failed_compiles
+
+
+def check_for_updates(recipes):
+    max_concurrency = CFG["max_concurrency"]
+
+    hash_cache = load_json_cache(HASH_CACHE_FILE)
+    recipe_cache = hash_cache.setdefault("recipes", {})
+    url_hashes = hash_cache.setdefault("urls", {})
+    file_hashes = hash_cache.setdefault("files", {})
+
+    hash_cache["runs"] = hash_cache.get("runs", 0) + 1
+    if hash_cache["runs"] % DEEP_VERIFY_INTERVAL == 0:
+        print_debug("=> Re-hashing all local source files this run.")
+        file_hashes.clear()
+
+    # The remote fetches are network bound, so first get all of the recipes,
+    # and then all of the sources listed in any of them, in parallel.
+    # Recipes and sources listed more than once are only fetched once, and
+    # fetched_sources then serves as the one copy of each source for the
+    # run. Everything that touches the disk or the compiler stays serial.
+    with ThreadPoolExecutor(max_workers=max_concurrency) as executor:
+        recipes = list(dict.fromkeys(recipes))
+        recipe_entries = []
+        for recipe, r in zip(recipes, executor.map(
+                lambda recipe: fetch_recipe(recipe, recipe_cache), recipes)):
+            print_info("=> Checking for recipe updates: %s", recipe)
+            if r is None:
+                continue
+            # Like a failed request, a malformed recipe (e.g. an HTML error
+            # page, or entries of the wrong type) only skips that recipe.
+            try:
+                recipe_entries.append(
+                    (recipe, *get_recipe_entries(recipe, r, recipe_cache)))
+            except (ValueError, AttributeError, TypeError) as e:
+                print(f"Failed to parse recipe {recipe}: {e!r}")
+
+        source_urls = list(dict.fromkeys(
+            source_url
+            for _, includes, plugins in recipe_entries
+            for _, source_url in includes + plugins))
+        fetched_sources = dict(zip(source_urls, executor.map(
+            lambda source_url: fetch_source(source_url, url_hashes),
+            source_urls)))
+
+    recipe_results = []
+    for recipe, includes, plugins in recipe_entries:
+        recipe_results.append((recipe, includes, plugins, *update_from_recipe(
+            recipe, includes, plugins, fetched_sources, file_hashes)))
+
+    # Compile only once all of the recipes have been applied, so that every
+    # plugin gets built against the latest version of any include, and all
+    # of the compiles can run in parallel. A plugin updated by more than one
+    # recipe still only needs to be compiled once.
+    # Plugins that failed to compile on a previous run are retried as well,
+    # as long as their sources are still around.
+    pending_compiles = [
+        (plugin_name, local_source_path)
+        for plugin_name, local_source_path
+        in hash_cache.pop("pending_compiles", [])
+        if os.path.isfile(local_source_path)]
+    plugins_to_compile = list(dict.fromkeys(pending_compiles + [
+        plugin
+        for _, _, _, _, recipe_plugins_to_compile in recipe_results
+        for plugin in recipe_plugins_to_compile]))
+    failed_compiles = []
+    if len(plugins_to_compile) > 0:
+        print_info("=> Compiling %d updated plugins", len(plugins_to_compile))
+        failed_compiles = compile_plugins(plugins_to_compile)
+
+    # The sources of the plugins that failed to compile are up to date by
+    # now, so nothing would tell the next run to build them again; have it
+    # re-check them and remember to retry them.
+    for _, local_source_path in failed_compiles:
+        file_hashes.pop(os.path.abspath(local_source_path), None)
+    if len(failed_compiles) > 0:
+        hash_cache["pending_compiles"] = failed_compiles
+
+    # Save the cache only once the compiles are done, so that it reflects
+    # their outcome as well.
+    save_json_cache(HASH_CACHE_FILE, hash_cache)
+
+    for recipe, includes, plugins, num_incs_updated, \
+            recipe_plugins_to_compile in recipe_results:
+        num_plugins_updated = len([plugin
+                                   for plugin in recipe_plugins_to_compile
+                                   if plugin not in failed_compiles])
+        print_info("\n=> Recipe: %s\n"
+                   "%d of %d includes checked had received new updates.\n"
+                   "%d of %d plugins checked had received new updates.",
+                   recipe, num_incs_updated, len(includes),
+                   num_plugins_updated, len(plugins))
+
+    if len(failed_compiles) > 0:
+        raise RuntimeError("Failed to compile plugins: " + ", ".join(
+            plugin_name for plugin_name, _ in failed_compiles))
 
 
 def main():
-    print_info(f"=== Running {SCRIPT_NAME}, v.{SCRIPT_VERSION} ===\n"
-               f"Current time: {datetime.now()}")
+    init_config()
+    print_info("=== Running %s, v.%s ===\nCurrent time: %s",
+               SCRIPT_NAME, SCRIPT_VERSION, datetime.now())
+    # hashlib hands SHA-256 to OpenSSL, which picks the fastest code path the
+    # CPU supports (e.g. the SHA extensions on x86 and ARMv8) by itself.
+    print_debug("Hashing backend: %s", ssl.OPENSSL_VERSION)
     self_update()
-    for recipe in CFG["recipes"].data:
-        check_for_updates(recipe)
+    check_for_updates(CFG["recipes"])
 
 
 if __name__ == '__main__':